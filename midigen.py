@@ -1,4 +1,5 @@
 import argparse
+import sys
 
 import tokenizer
 
@@ -22,13 +23,16 @@ def main():
     
     if args.print_tokens:
         print("Token sequence:")
-        print(tokens)
+        sys.stdout.write('[')
+        sys.stdout.write(', '.join(map(str, tokens)))
+        sys.stdout.write(']\n')
         print(f"Total tokens: {len(tokens)}")
     
     if args.print_readable:
         print("Human-readable token sequence:")
-        for token in tokens:
-            print(tokenizer.token_to_readable(token))
+        if tokens:
+            sys.stdout.write('\n'.join(map(tokenizer.token_to_readable, tokens)))
+            sys.stdout.write('\n')
     
     # Convert tokens back to MIDI if output file is specified
     if args.output:
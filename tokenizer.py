@@ -1,5 +1,10 @@
-import ast
-from collections import defaultdict
+import array
+import bisect
+import functools
+import heapq
+import struct
+
+import mido
 
 # Define token ranges as specified in the document
 # Note events (0-255)
@@ -51,84 +56,128 @@ additional_shifts = [
 TIME_SHIFTS.extend(additional_shifts)
 assert len(TIME_SHIFTS) == 32, f"Expected 32 time shifts, got {len(TIME_SHIFTS)}"
 
-# Create mappings for time shifts
-TIME_SHIFT_MAP = {shift: TIME_SHIFT_BASE + i for i, shift in enumerate(TIME_SHIFTS)}
-REVERSE_TIME_SHIFT_MAP = {TIME_SHIFT_BASE + i: shift for i, shift in enumerate(TIME_SHIFTS)}
-
 # Special tokens
 START_SEQUENCE = 288  # Token to mark the beginning of a sequence
 END_SEQUENCE = 289    # Token to mark the end of a sequence
 
+# Decoder dispatch tables indexed by token: _KIND gives the token class
+# (0 = special, 1 = NOTE_ON, 2 = NOTE_OFF, 3 = TIME_SHIFT) for each token in
+# the vocabulary; _PAYLOAD gives the shift in ticks of each TIME_SHIFT token.
+_KIND = bytearray(END_SEQUENCE + 1)
+_PAYLOAD = array.array('H', [0] * (END_SEQUENCE + 1))
+_KIND[NOTE_ON_MIN:NOTE_ON_MAX + 1] = b'\x01' * (NOTE_ON_MAX - NOTE_ON_MIN + 1)
+_KIND[NOTE_OFF_MIN:NOTE_OFF_MAX + 1] = b'\x02' * (NOTE_OFF_MAX - NOTE_OFF_MIN + 1)
+for _i, _shift in enumerate(TIME_SHIFTS):
+    _KIND[TIME_SHIFT_BASE + _i], _PAYLOAD[TIME_SHIFT_BASE + _i] = 3, _shift
+del _i, _shift
+
+# The additional shifts are evenly spaced, so deltas from the first of them
+# upwards map to a token arithmetically; a delta exactly halfway between two
+# shifts resolves to the smaller one, as in the bisection below.
+_LINEAR_SHIFT_INDEX = len(TIME_SHIFTS) - len(additional_shifts)
+_LINEAR_SHIFT_START = additional_shifts[0]
+_LINEAR_SHIFT_STEP = additional_shifts[1] - additional_shifts[0]
+assert additional_shifts == list(range(_LINEAR_SHIFT_START, additional_shifts[-1] + 1, _LINEAR_SHIFT_STEP))
+
+# Midpoints between the shifts below the linear range and its first shift, for
+# nearest-shift lookup by bisection of shorter deltas
+_THRESHOLDS = [(TIME_SHIFTS[i] + TIME_SHIFTS[i + 1]) / 2 for i in range(_LINEAR_SHIFT_INDEX)]
+_TOKENS = [TIME_SHIFT_BASE + i for i in range(_LINEAR_SHIFT_INDEX + 1)]
+
+@functools.lru_cache(maxsize=4096)
 def find_closest_time_shift(delta_time):
     """Find the closest time-shift token for a given delta time."""
-    if delta_time == 0:
+    if delta_time >= _LINEAR_SHIFT_START:
+        steps = (delta_time - _LINEAR_SHIFT_START + _LINEAR_SHIFT_STEP // 2 - 1) // _LINEAR_SHIFT_STEP
+        return TIME_SHIFT_BASE + _LINEAR_SHIFT_INDEX + min(steps, len(additional_shifts) - 1)
+    
+    if delta_time <= 0:
         return None  # No time shift needed
     
-    # Find the closest time-shift value
-    closest_shift = min(TIME_SHIFTS, key=lambda x: abs(x - delta_time))
+    return _TOKENS[bisect.bisect_left(_THRESHOLDS, delta_time)]
+
+# Integer event kinds for note events. Note-offs get the smaller value so that
+# comparing (time, kind, note) tuples releases a re-struck note before it sounds
+# again at the same tick, matching the original 'note_off' < 'note_on' order.
+_NOTE_OFF_EVENT = 0
+_NOTE_ON_EVENT = 1
+
+def _track_note_events(track):
+    """Yield (absolute_time, kind, note) for the note events of one track, in sorted order.
+
+    kind is _NOTE_OFF_EVENT or _NOTE_ON_EVENT. Events sharing a tick are
+    sorted, as the file may list them in any order.
+    """
+    absolute_time = 0
+    tick_events = []
     
-    # Get the corresponding token
-    return TIME_SHIFT_MAP[closest_shift]
+    for msg in track:
+        if msg.time:
+            # Flush the events of the previous tick
+            if tick_events:
+                tick_events.sort()
+                yield from tick_events
+                tick_events = []
+            absolute_time += msg.time
+        
+        if msg.type == 'note_on' and msg.velocity > 0:
+            # Note on event
+            tick_events.append((absolute_time, _NOTE_ON_EVENT, msg.note))
+        elif msg.type == 'note_off' or (msg.type == 'note_on' and msg.velocity == 0):
+            # Note off event (note_on with velocity 0 is equivalent to note_off)
+            tick_events.append((absolute_time, _NOTE_OFF_EVENT, msg.note))
+    
+    tick_events.sort()
+    yield from tick_events
 
 def midi_to_tokens(midi_file):
     """Convert a MIDI file to a sequence of tokens according to the specified tokenization scheme."""
-    import mido
-
     # Load the MIDI file
     mid = mido.MidiFile(midi_file)
     
-    # Extract all note events with absolute time
-    events = []
-    
-    for track in mid.tracks:
-        absolute_time = 0
-        
-        for msg in track:
-            absolute_time += msg.time
-            
-            if msg.type == 'note_on' and msg.velocity > 0:
-                # Note on event
-                events.append((absolute_time, 'note_on', msg.note))
-            elif msg.type == 'note_off' or (msg.type == 'note_on' and msg.velocity == 0):
-                # Note off event (note_on with velocity 0 is equivalent to note_off)
-                events.append((absolute_time, 'note_off', msg.note))
+    # Each track's events are already sorted, so merge the per-track streams
+    # rather than sorting all events. Comparing whole (time, kind, note) tuples
+    # puts note-offs ahead of note-ons at each tick (so a re-struck note is
+    # released before it sounds again) and simultaneous notes in pitch order
+    events = heapq.merge(*map(_track_note_events, mid.tracks))
     
-    # Sort events by time
-    events.sort()
+    # Convert events to tokens; every token fits in an unsigned 16-bit slot
+    tokens = array.array('H', [START_SEQUENCE])
+    append = tokens.append
     
-    # Convert events to tokens
-    tokens = [START_SEQUENCE]
-    
-    for i, event in enumerate(events):
-        time, event_type, note = event
-        
-        # Add the note event token
-        if event_type == 'note_on':
-            tokens.append(note)  # NOTE_ON token is the pitch value (0-127)
-        else:  # 'note_off'
-            tokens.append(note + 128)  # NOTE_OFF token is pitch value + 128 (128-255)
+    prev_time = None
+    for time, kind, note in events:
+        # Add a time shift token for the gap since the previous event;
+        # simultaneous events have no time shift between them
+        if prev_time is not None and time > prev_time:
+            append(find_closest_time_shift(time - prev_time))
+        prev_time = time
         
-        # Add time shift token if there is a next event
-        if i < len(events) - 1:
-            next_time = events[i+1][0]
-            delta_time = next_time - time
-            if delta_time > 0:
-                time_shift_token = find_closest_time_shift(delta_time)
-                if time_shift_token is not None:
-                    tokens.append(time_shift_token)
+        # Add the note event token (kind is _NOTE_ON_EVENT when truthy)
+        if kind:
+            append(note)  # NOTE_ON token is the pitch value (0-127)
+        else:
+            append(note + 128)  # NOTE_OFF token is pitch value + 128 (128-255)
     
     # Add the end sequence token
     tokens.append(END_SEQUENCE)
     
     return tokens
 
+def _encode_variable_int(value):
+    """Encode a non-negative int as a MIDI variable-length quantity."""
+    encoded = [value & 0x7F]
+    value >>= 7
+    while value:
+        encoded.append((value & 0x7F) | 0x80)
+        value >>= 7
+    encoded.reverse()
+    return encoded
+
 def tokens_to_midi(tokens, output_file, ticks_per_beat=480, velocity=64):
     """Convert a sequence of tokens back to a MIDI file."""
-    import mido
-    
-    mid = mido.MidiFile(ticks_per_beat=ticks_per_beat)
-    track = mido.MidiTrack()
-    mid.tracks.append(track)
+    if not 0 <= velocity <= 127:
+        raise ValueError(f"velocity must be in range 0..127, got {velocity}")
     
     # Skip START_SEQUENCE token if present
     start_idx = 0
@@ -142,65 +191,97 @@ def tokens_to_midi(tokens, output_file, ticks_per_beat=480, velocity=64):
     
     tokens = tokens[start_idx:end_idx]
     
+    # Encode the track data directly as Standard MIDI File bytes. Time shifts
+    # are non-negative, so events come out in time order and each is written
+    # with its delta from the previous event. Consecutive events with the same
+    # status byte use running status, as mido does when saving.
+    data = bytearray()
     current_time = 0
-    pending_events = []  # Events to be written with their absolute time
+    last_time = 0
+    running_kind = None
+    
+    # Pre-encode every note event once per call (velocity varies per call),
+    # with and without its status byte, so each event is a single extend
+    # (kind 1 = NOTE_ON, 2 = NOTE_OFF)
+    with_status = [None] * (NOTE_OFF_MAX + 1)
+    without_status = [None] * (NOTE_OFF_MAX + 1)
+    for token in range(NOTE_ON_MIN, NOTE_ON_MAX + 1):
+        with_status[token] = bytes((0x90, token, velocity))
+        without_status[token] = bytes((token, velocity))
+    for token in range(NOTE_OFF_MIN, NOTE_OFF_MAX + 1):
+        with_status[token] = bytes((0x80, token - 128, 0))
+        without_status[token] = bytes((token - 128, 0))
     
-    i = 0
-    while i < len(tokens):
-        token = tokens[i]
+    # Bind globals and attributes used per token to locals
+    kinds = _KIND
+    vocab_size = len(_KIND)
+    payloads = _PAYLOAD
+    append = data.append
+    extend = data.extend
+    encode_variable_int = _encode_variable_int
+    
+    for token in tokens:
+        # Tokens outside the vocabulary are ignored as unknown
+        kind = kinds[token] if 0 <= token < vocab_size else 0
         
-        if NOTE_ON_MIN <= token <= NOTE_ON_MAX:
-            # NOTE_ON token
-            note = token
-            pending_events.append((current_time, mido.Message('note_on', note=note, velocity=velocity, time=0)))
+        if kind == 3:
+            # TIME_SHIFT token
+            current_time += payloads[token]
             
-        elif NOTE_OFF_MIN <= token <= NOTE_OFF_MAX:
-            # NOTE_OFF token
-            note = token - 128
-            pending_events.append((current_time, mido.Message('note_off', note=note, velocity=0, time=0)))
+        elif kind:
+            # NOTE_ON or NOTE_OFF token
+            delta_time = current_time - last_time
+            last_time = current_time
+            if delta_time < 0x80:
+                append(delta_time)
+            else:
+                extend(encode_variable_int(delta_time))
             
-        elif token in REVERSE_TIME_SHIFT_MAP:
-            # TIME_SHIFT token
-            time_shift = REVERSE_TIME_SHIFT_MAP[token]
-            current_time += time_shift
-        
-        i += 1
+            if kind == running_kind:
+                extend(without_status[token])
+            else:
+                extend(with_status[token])
+                running_kind = kind
     
-    # Sort pending events by time
-    pending_events.sort(key=lambda x: x[0])
-    
-    # Convert absolute times to delta times
-    last_time = 0
-    for abs_time, msg in pending_events:
-        delta_time = abs_time - last_time
-        msg.time = int(delta_time)  # Convert to integer to ensure MIDI compatibility
-        track.append(msg)
-        last_time = abs_time
+    # End of track meta event
+    extend(b'\x00\xff\x2f\x00')
     
-    mid.save(output_file)
+    with open(output_file, 'wb') as f:
+        # Type 1 file with a single track, matching mido's default
+        f.write(struct.pack('>4sLhhh', b'MThd', 6, 1, 1, ticks_per_beat))
+        f.write(struct.pack('>4sL', b'MTrk', len(data)))
+        f.write(data)
+
+# Readable names for every token in the vocabulary, indexed by token
+_READABLE = ([f"NOTE_ON {note}" for note in range(NOTE_ON_MIN, NOTE_ON_MAX + 1)]
+             + [f"NOTE_OFF {token - 128}" for token in range(NOTE_OFF_MIN, NOTE_OFF_MAX + 1)]
+             + [f"TIME_SHIFT {shift}" for shift in TIME_SHIFTS]
+             + ["START_SEQUENCE", "END_SEQUENCE"])
+assert len(_READABLE) == END_SEQUENCE + 1
 
 def token_to_readable(token):
     """Convert a token to a human-readable string."""
-    if token == START_SEQUENCE:
-        return "START_SEQUENCE"
-    elif token == END_SEQUENCE:
-        return "END_SEQUENCE"
-    elif NOTE_ON_MIN <= token <= NOTE_ON_MAX:
-        return f"NOTE_ON {token}"
-    elif NOTE_OFF_MIN <= token <= NOTE_OFF_MAX:
-        return f"NOTE_OFF {token - 128}"
-    elif token in REVERSE_TIME_SHIFT_MAP:
-        return f"TIME_SHIFT {REVERSE_TIME_SHIFT_MAP[token]}"
-    else:
-        return f"UNKNOWN {token}"
+    if 0 <= token < len(_READABLE):
+        return _READABLE[token]
+    return f"UNKNOWN {token}"
+
+_TOKEN_LIST_PUNCTUATION = str.maketrans('[](),', '     ')
 
 def read_tokens_from_file(file_path):
-    """Read tokens from a text file."""
+    """Read tokens from a text file.
+
+    The file holds integer tokens either as a Python-style list or tuple
+    (e.g. "[288, 60, 266]") or one token per line. Tokens must fit in 16 bits
+    (0-65535); values in that range outside the vocabulary are read and later
+    ignored as unknown.
+    """
     with open(file_path, 'r') as f:
         content = f.read()
-        try:
-            # Try to parse as a Python list
-            return ast.literal_eval(content)
-        except:
-            # If not a Python list, assume one token per line
-            return [int(line.strip()) for line in content.split('\n') if line.strip()] 
\ No newline at end of file
+    
+    # Drop the brackets and commas and parse the remaining whitespace-separated ints
+    values = [int(value) for value in content.translate(_TOKEN_LIST_PUNCTUATION).split()]
+    try:
+        return array.array('H', values)
+    except OverflowError:
+        bad_token = next(value for value in values if not 0 <= value <= 0xFFFF)
+        raise ValueError(f"Token {bad_token} in {file_path} is outside the 16-bit token range") from None
\ No newline at end of file